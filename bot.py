@@ -1,6 +1,7 @@
 from telegram import ParseMode, ReplyKeyboardMarkup, KeyboardButton
 from telegram.ext import Updater, CommandHandler, MessageHandler, Filters
 from igo import *
+import tempfile
 
 igraph = None  # The iGraph used by the bot
 locations = {}  # Contains the location for each user
@@ -71,17 +72,20 @@ def go(update, context):
         target = igraph.get_location(text)
         if target is not None:
             if get_chat_id(update) in locations.keys():
-                filename = "%s.png" % get_chat_id(update)
-                path = igraph.get_shortest_path(
-                    locations[get_chat_id(update)], target, filename)
-                if path is not None:
-                    print("Path from %s to %s" % (str(path[0]), str(path[-1])))
-                    send_map(update, context, filename)
-                    os.remove(filename)
-                else:
-                    send_message(
-                        update, context, "⛔ There is no possible path \
+                filename = get_map_filename()
+                try:
+                    path = igraph.get_shortest_path(
+                        locations[get_chat_id(update)], target, filename)
+                    if path is not None:
+                        print("Path from %s to %s" %
+                              (str(path[0]), str(path[-1])))
+                        send_map(update, context, filename)
+                    else:
+                        send_message(
+                            update, context, "⛔ There is no possible path \
 between the two locations! ⛔")
+                finally:
+                    os.remove(filename)
             else:
                 send_message(
                     update, context, "🚫 I don't have your location 📍. \
@@ -100,9 +104,12 @@ def where(update, context):
     '''
     if get_chat_id(update) in locations.keys():
         print("Location to show:", locations[get_chat_id(update)])
-        filename = "%s.png" % get_chat_id(update)
-        igraph.get_location_map(locations[get_chat_id(update)], filename)
-        send_map(update, context, filename)
+        filename = get_map_filename()
+        try:
+            igraph.get_location_map(locations[get_chat_id(update)], filename)
+            send_map(update, context, filename)
+        finally:
+            os.remove(filename)
         send_message(
             update, context, "ℹ️ Send me your actual location 📍 if you \
 want to change it")
@@ -193,9 +200,9 @@ def send_map(update, context, filename):
     This funcion does not return anything.
     '''
     try:
-        context.bot.send_photo(
-            chat_id=update.effective_chat.id,
-            photo=open(filename, 'rb'))
+        with open(filename, 'rb') as photo:
+            context.bot.send_photo(
+                chat_id=update.effective_chat.id, photo=photo)
     except Exception as e:
         print(e)
         context.bot.send_message(
@@ -203,6 +210,17 @@ def send_map(update, context, filename):
             text='💣')
 
 
+def get_map_filename():
+    '''
+    Creates an empty image file with a unique name, so that concurrent
+    commands do not overwrite each other's map.
+    Returns a string with the name of the image.
+    '''
+    fd, filename = tempfile.mkstemp(suffix='.png')
+    os.close(fd)
+    return filename
+
+
 def get_chat_id(update):
     '''
     Auxiliary function to get chat id
@@ -243,8 +261,9 @@ def main():
     dispatcher.add_handler(CommandHandler('start', start))
     dispatcher.add_handler(CommandHandler('help', help))
     dispatcher.add_handler(CommandHandler('author', author))
-    dispatcher.add_handler(CommandHandler('go', go))
-    dispatcher.add_handler(CommandHandler('pos', pos))
+    # Run concurrently so that iGraph can coalesce simultaneous requests
+    dispatcher.add_handler(CommandHandler('go', go, run_async=True))
+    dispatcher.add_handler(CommandHandler('pos', pos, run_async=True))
     dispatcher.add_handler(CommandHandler('where', where))
     dispatcher.add_handler(MessageHandler(Filters.location, set_location))
     updater.start_polling()
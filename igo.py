@@ -1,19 +1,36 @@
 import collections
+import concurrent.futures
+import hashlib
+import heapq
+import math
+import multiprocessing
+import multiprocessing.pool
 import networkx as nx
+import numpy as np
 import osmnx as ox
 import pandas as pd
 import os.path
 import pickle
 import csv
 import urllib
-from shapely.geometry import LineString
+from sklearn.neighbors import BallTree
 from staticmap import StaticMap, CircleMarker, Line
 import threading
+import time
 
 PLACE = 'Barcelona, Catalonia'
+METRO_PLACE = 'Àrea metropolitana de Barcelona, Catalonia'
 IMAGE_FILENAME = 'barcelona.png'
-GRAPH_FILENAME = 'barcelona.graph'
-HIGHWAYS_FILENAME = 'barcelona.highways'
+CACHE_DIRNAME = 'barcelona.cache'
+CACHE_VERSION = 2  # Bump when the format of the cached artifacts changes
+HISTORY_DIRNAME = 'congestions'
+CELLS_DIRNAME = 'barcelona.cells'
+OVERLAY_FILENAME = os.path.join(CELLS_DIRNAME, 'overlay.graph')
+SKELETON_FILENAME = os.path.join(CELLS_DIRNAME, 'skeleton.graph')
+CELL_SIZE = 0.02  # Side of the cells of the partition, in degrees
+MAX_LOADED_CELLS = 16  # Cells of the partition kept in memory
+BATCH_WINDOW = 0.005  # Seconds that requests wait to be batched together
+SHARED_SEARCH_SOURCES = 3  # Sources to a target routed with a single search
 HIGHWAYS_URL = 'https://opendata-ajuntament.barcelona.cat/data/dataset/1090983\
 a-1c40-4609-8620-14ad49aae3ab/resource/1d6c814c-70ef-4147-aa16-a49ddb952f72/do\
 wnload/transit_relacio_trams.csv'
@@ -21,30 +38,343 @@ CONGESTIONS_URL = 'https://opendata-ajuntament.barcelona.cat/data/dataset/8319\
 c2b1-4c21-4962-9acd-6db4c5ff1148/resource/2d456eb5-4ea6-4f68-9794-2f3f1a58a933\
 /download'
 
-Highway = collections.namedtuple('Highway', 'description coords')
-Congestion = collections.namedtuple('Congestion', 'date actual predicted')
+# Parallel arrays indexed by dense highway ids, sorted by way_id. The points
+# of the highway i are coords[offsets[i]:offsets[i+1]].
+Highways = collections.namedtuple(
+    'Highways', 'way_id description offsets coords')
+# Parallel arrays sorted by way_id, with the latest congestion of each highway
+Congestions = collections.namedtuple(
+    'Congestions', 'way_id date actual predicted')
+# The edges covered by the highway i are edges[offsets[i]:offsets[i+1]]
+HighwaysEdges = collections.namedtuple('HighwaysEdges', 'way_id offsets edges')
 Location = collections.namedtuple('Location', 'lon lat')
 
 
+def get_history_timestamps():
+    '''
+    Lists the timestamps of the congestion snapshots stored in the history.
+    Returns a sorted list of integers formatted as YYYYMMDDhhmmss.
+    '''
+    timestamps = []
+    if os.path.isdir(HISTORY_DIRNAME):
+        for day in os.listdir(HISTORY_DIRNAME):
+            if not os.path.isdir(os.path.join(HISTORY_DIRNAME, day)):
+                continue
+            for filename in os.listdir(os.path.join(HISTORY_DIRNAME, day)):
+                if filename.endswith('.npz'):
+                    timestamps.append(int(filename[:-len('.npz')]))
+    return sorted(timestamps)
+
+
+def evaluate_routes(pairs, timestamps=None, processes=None):
+    '''
+    Reroutes a set of origin-destination pairs under each of the stored
+    congestion snapshots, using a process for each available core.
+    Params:
+        - pairs: A list of (source, target) tuples of Locations.
+        - timestamps = None: The timestamps of the snapshots to evaluate. If
+        None, every snapshot in the history is used.
+        - processes = None: The number of processes to use. If None, all the
+        cores are used.
+    Returns a dictionary mapping each timestamp to the list of itimes of the
+    pairs, in the same order. Unreachable pairs have None as itime.
+    '''
+    if timestamps is None:
+        timestamps = get_history_timestamps()
+    with multiprocessing.Pool(processes) as pool:
+        results = pool.map(_evaluate_snapshot,
+                           [(timestamp, pairs) for timestamp in timestamps])
+    return dict(zip(timestamps, results))
+
+
+def _evaluate_snapshot(args):
+    '''
+    Worker of evaluate_routes, rebuilds the igraph of a single snapshot and
+    routes all the pairs on it.
+    Params:
+        - args: A tuple with the timestamp of the snapshot and the pairs.
+    Returns the list of itimes of the pairs.
+    '''
+    timestamp, pairs = args
+    return iGraph(timestamp).get_travel_times(pairs)
+
+
+# Graph held by each process of the pool of _parallel_map
+_worker_graph = None
+
+
+def _init_worker(graph):
+    '''
+    Initializes a process of the pool of _parallel_map.
+    Params:
+        - graph: The graph used by the process.
+    This function does not return anything.
+    '''
+    global _worker_graph
+    _worker_graph = graph
+
+
+def _run_chunk(args):
+    '''
+    Runs a chunk of _parallel_map on the graph of the process.
+    Params:
+        - args: A tuple with the function and the chunk of items.
+    Returns the result of the function.
+    '''
+    function, chunk = args
+    return function(_worker_graph, chunk)
+
+
+def _parallel_map(function, graph, items):
+    '''
+    Applies a function to contiguous chunks of items across a pool of
+    processes, each one holding its own copy of the graph.
+    Params:
+        - function: A module level function that receives the graph and a
+        chunk of items.
+        - graph: The graph passed to the function.
+        - items: A list or an array of items.
+    Returns the list of results of the chunks, in the order of items.
+    '''
+    processes = os.cpu_count() or 1
+    # Processes of a pool cannot start a pool of their own
+    if processes == 1 or len(items) < processes or \
+            multiprocessing.current_process().daemon:
+        return [function(graph, items)]
+
+    size = math.ceil(len(items) / processes)
+    chunks = [items[i:i+size] for i in range(0, len(items), size)]
+    with multiprocessing.Pool(processes, initializer=_init_worker,
+                              initargs=(graph,)) as pool:
+        return pool.map(_run_chunk, [(function, chunk) for chunk in chunks])
+
+
+def _project_highways_chunk(graph, coords):
+    '''
+    Converts a chunk of points of the highways to node ids with a single
+    nearest nodes search.
+    Params:
+        - graph: The graph of the streets.
+        - coords: An array with the coordinates of each point.
+    Returns an array with the node id of each point.
+    '''
+    if len(coords) == 0:
+        return np.array([], dtype=np.int64)
+    return np.asarray(ox.get_nearest_nodes(
+        graph, coords[:, 0], coords[:, 1], method='balltree'), dtype=np.int64)
+
+
+def _map_highways_chunk(graph, highways_nodes):
+    '''
+    Maps a chunk of highways to the edges of the graph they cover: the
+    shortest path between each pair of consecutive nodes.
+    Params:
+        - graph: The graph of the streets.
+        - highways_nodes: A list with the array of node ids of each highway.
+    Returns a list with the list of edges of each highway.
+    '''
+    highways_edges = []
+    for nodes in highways_nodes:
+        nodes = nodes.tolist()
+        edges = []
+        for i in range(1, len(nodes)):
+            try:
+                path = nx.shortest_path(
+                    graph, source=nodes[i-1], target=nodes[i],
+                    weight='length')
+            except nx.NetworkXNoPath:
+                continue
+            edges.extend(zip(path[:-1], path[1:]))
+        highways_edges.append(edges)
+    return highways_edges
+
+
+def _estimate_congestions(in_edges, out_edges, congestion):
+    '''
+    Estimates the congestions that are missing. The graph is given as the
+    ids of the edges entering and leaving each node, in the order of the
+    nodes of the graph.
+    Params:
+        - in_edges: A list with the list of ids of the in edges of each node.
+        - out_edges: A list with the list of ids of the out edges of each
+        node.
+        - congestion: A list with the congestion of each edge, 0 for "No
+        data". It is modified in place.
+    Returns the resulting list of congestions.
+    '''
+    # For each iteration for each node extend the average congestion of
+    # the adjacent
+    # streets with known congestion to the adjacent streets with unknown
+    # congestion.
+    for iteration in range(6):
+        for node_in_edges, node_out_edges in zip(in_edges, out_edges):
+            congestionSum = 0
+            congestionCount = 0
+            for edge in node_in_edges:
+                if congestion[edge] > 0:
+                    congestionSum += congestion[edge]
+                    congestionCount += 1
+            for edge in node_out_edges:
+                if congestion[edge] > 0:
+                    congestionSum += congestion[edge]
+                    congestionCount += 1
+            if congestionCount > 0:
+                averageCongestion = congestionSum//congestionCount
+                for edge in node_in_edges:
+                    if congestion[edge] == 0:
+                        congestion[edge] = max(1, averageCongestion-1)
+                for edge in node_out_edges:
+                    if congestion[edge] == 0:
+                        congestion[edge] = max(1, averageCongestion)
+
+    # The remaining streets are very isolated so we can assume there won't
+    # be many people using them.
+    for node_in_edges in in_edges:
+        for edge in node_in_edges:
+            if congestion[edge] == 0:
+                congestion[edge] = 1
+
+    return congestion
+
+
+class _Batcher:
+    '''
+    Coalesces the requests made from different threads. Identical requests
+    in flight share a single computation, and distinct requests arriving
+    within a short window are computed together in a single call. The
+    window is only waited when other requests are in flight, so a lone
+    request is computed right away.
+    '''
+
+    def __init__(self, function, window):
+        '''
+        The class constructor
+        Params:
+            - function: A function that receives a list of items and returns
+            the list of their results. A result that is an exception is
+            raised only to the request of its item.
+            - window: The seconds to wait for other requests to batch.
+        '''
+        self._function = function
+        self._window = window
+        self._lock = threading.Lock()
+        self._batch = None  # Requests of the batch being collected
+        self._in_flight = {}  # Futures of the requests not finished yet
+
+    def submit(self, key, item):
+        '''
+        Requests the result of an item, waiting for it to be computed.
+        Params:
+            - key: A hashable value identifying the request.
+            - item: The item passed to the function.
+        Returns the result of the item.
+        '''
+        return self.submit_many([(key, item)])[0]
+
+    def submit_many(self, requests):
+        '''
+        Requests the results of several items at once, so they can share a
+        batch, waiting for them to be computed.
+        Params:
+            - requests: A list of (key, item) tuples.
+        Returns the list of results of the items.
+        '''
+        futures = []
+        with self._lock:
+            # Only wait for other requests if there is concurrent traffic
+            busy = len(self._in_flight) > 0
+            leader = False
+            for key, item in requests:
+                if key in self._in_flight:
+                    futures.append(self._in_flight[key])
+                    continue
+                future = concurrent.futures.Future()
+                self._in_flight[key] = future
+                # The first request of a batch computes the whole batch
+                if self._batch is None:
+                    self._batch = {}
+                    leader = True
+                self._batch[key] = (item, future)
+                futures.append(future)
+
+        if leader:
+            if busy:
+                time.sleep(self._window)
+            with self._lock:
+                batch = self._batch
+                self._batch = None
+            keys = list(batch.keys())
+            try:
+                results = self._function([batch[key][0] for key in keys])
+                for key, result in zip(keys, results):
+                    if isinstance(result, Exception):
+                        batch[key][1].set_exception(result)
+                    else:
+                        batch[key][1].set_result(result)
+            except Exception as e:
+                for key in keys:
+                    batch[key][1].set_exception(e)
+            finally:
+                with self._lock:
+                    for key in keys:
+                        del self._in_flight[key]
+
+        return [future.result() for future in futures]
+
+
 class iGraph:
 
-    def __init__(self):
-        '''The class constructor'''
-        graph = self._get_graph()
+    def __init__(self, timestamp=None, partitioned=False):
+        '''
+        The class constructor
+        Params:
+            - timestamp = None: If given, the igraph is rebuilt offline from
+            the latest stored congestions at or before this timestamp
+            (formatted as YYYYMMDDhhmmss) and it is not updated afterwards.
+            - partitioned = False: If True, the whole metropolitan area is
+            covered by a partition in cells stored on disk, and only the
+            cells touched by each query are loaded.
+        '''
+        if partitioned and timestamp is not None:
+            raise ValueError("Replay is not available in partitioned mode")
 
-        # download highways and parse them accordingly
-        self._highways = self._get_highways(graph)
+        if timestamp is None:
+            # download congestions and parse them accordingly
+            self._congestions = self._download_congestions(CONGESTIONS_URL)
+            self._save_congestions(self._congestions)
+        else:
+            # replay the congestions stored in the history
+            self._congestions = self._load_congestions(timestamp)
 
-        # download congestions and parse them accordingly
-        self._congestions = self._download_congestions(CONGESTIONS_URL)
+        # cells of the partition loaded in memory, least recently used first
+        self._cells = collections.OrderedDict()
+        self._cells_lock = threading.Lock()
+        # times each cell has been customized since the partition was loaded
+        self._cells_generations = collections.defaultdict(int)
 
-        # get the 'intelligent graph' version of a graph taking into account
-        # the congestions of the highways
-        self._igraph = self._build_igraph(
-            graph, self._highways, self._congestions)
+        if partitioned:
+            self._highways_edges = None
+            self._igraph = None
+            self._overlay = self._get_overlay(self._congestions)
+        else:
+            self._overlay = None
+
+            # get the 'intelligent graph' version of a graph taking into
+            # account the congestions of the highways
+            self._highways_edges, self._igraph = \
+                self._build_igraph(self._congestions)
+
+            # the nodes never change, so they are indexed only once
+            self._index_nodes()
+
+        # coalesce the requests of simultaneous users
+        self._geocode_batcher = _Batcher(self._geocode_strings, 0)
+        self._snap_batcher = _Batcher(self._snap_locations, BATCH_WINDOW)
+        self._route_batcher = _Batcher(self._route_pairs, BATCH_WINDOW)
 
         # update igraph every 5 minutes
-        self._update_igraph()
+        if timestamp is None:
+            self._update_igraph()
 
     def get_shortest_path(self, source_loc, target_loc, filename):
         '''
@@ -56,18 +386,54 @@ class iGraph:
         Returns a list of locations along the resulting path, if there is no
         path None is returned.
         '''
-        source = ox.get_nearest_nodes(
-            self._igraph, [source_loc.lon], [source_loc.lat])[0]
-        target = ox.get_nearest_nodes(
-            self._igraph, [target_loc.lon], [target_loc.lat])[0]
-        if nx.has_path(self._igraph, source=source, target=target):
-            node_path = nx.shortest_path(
-                self._igraph, source=source, target=target, weight='itime')
+        if self._overlay is not None:
+            result = self._get_partition_path(source_loc, target_loc)
+            if result is None:
+                return None
+            coords_path = result[1]
+            self._generate_map(coords_path, filename)
+            return coords_path
+
+        source, target = self._snap_batcher.submit_many(
+            [(source_loc, source_loc), (target_loc, target_loc)])
+        node_path = self._route_batcher.submit(
+            (source, target), (source, target))
+        if node_path is not None:
             coords_path = self._get_path_coords(node_path)
             self._generate_map(coords_path, filename)
             return coords_path
         return None
 
+    def get_travel_times(self, pairs):
+        '''
+        Computes the itime of the shortest path of each pair of locations.
+        Params:
+            - pairs: A list of (source, target) tuples of Locations.
+        Returns a list with the itime of each pair, None if there is no path.
+        '''
+        if self._overlay is not None:
+            results = [self._get_partition_path(source, target)
+                       for source, target in pairs]
+            return [None if result is None else result[0]
+                    for result in results]
+
+        nodes = self._snap_locations(
+            [source for source, target in pairs] +
+            [target for source, target in pairs])
+        sources, targets = nodes[:len(pairs)], nodes[len(pairs):]
+
+        # Pairs sharing the source share a single search
+        lengths = {}
+        for source in set(sources):
+            lengths[source] = nx.single_source_dijkstra_path_length(
+                self._igraph, source, weight='itime')
+
+        # Pairs only connected through blocked streets have no path either
+        itimes = [lengths[source].get(target)
+                  for source, target in zip(sources, targets)]
+        return [None if itime == float('inf') else itime
+                for itime in itimes]
+
     def get_location(self, string):
         '''
         Gets the location of the node associated with the given string.
@@ -81,15 +447,140 @@ class iGraph:
             try:
                 x = float(parts[0])
                 y = float(parts[1])
-                node = ox.get_nearest_nodes(self._igraph, [x], [y])[0]
-                return Location(self._igraph.nodes[node]['x'],
-                                self._igraph.nodes[node]['y'])
+                return self._get_nearest_location(Location(x, y))
             except:
-                location = ox.geocode(string)
-                node = ox.get_nearest_nodes(
-                    self._igraph, [location[1]], [location[0]])[0]
-                node_info = self._igraph.nodes[node]
-                return Location(node_info['x'], node_info['y'])
+                location = self._geocode_batcher.submit(string, string)
+                return self._get_nearest_location(
+                    Location(location[1], location[0]))
+
+    def _get_nearest_location(self, location):
+        '''
+        Gets the location of the node nearest to the given location.
+        Params:
+            - location: The Location to snap.
+        Returns the resulting location, None if there is no node around.
+        '''
+        if self._overlay is not None:
+            snapped = self._snap_to_partition(location)
+            return None if snapped is None else snapped[1]
+        node = self._snap_batcher.submit(location, location)
+        node_info = self._igraph.nodes[node]
+        return Location(node_info['x'], node_info['y'])
+
+    # Functions for batching requests
+
+    def _geocode_strings(self, strings):
+        '''
+        Geocodes a batch of strings.
+        Params:
+            - strings: A list of names of places.
+        Returns a list with the (lat, lon) tuple of each string, or the
+        exception raised when geocoding it.
+        '''
+        results = []
+        for string in strings:
+            try:
+                results.append(ox.geocode(string))
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def _index_nodes(self):
+        '''
+        Indexes the nodes of the igraph by their coordinates, so that they
+        can be snapped with a single search.
+        This function does not return anything.
+        '''
+        self._nodes = list(self._igraph.nodes)
+        self._nodes_tree = BallTree(
+            np.radians([[self._igraph.nodes[node]['y'],
+                         self._igraph.nodes[node]['x']]
+                        for node in self._nodes]),
+            metric='haversine')
+
+    def _snap_locations(self, locations):
+        '''
+        Gets the nodes nearest to a batch of locations with a single search.
+        Params:
+            - locations: A list of Locations.
+        Returns a list with the node id of each location.
+        '''
+        indices = self._nodes_tree.query(
+            np.radians([[location.lat, location.lon]
+                        for location in locations]),
+            k=1, return_distance=False)
+        return [self._nodes[index] for index in indices[:, 0]]
+
+    def _route_pairs(self, pairs):
+        '''
+        Computes the shortest paths of a batch of pairs of nodes. When at
+        least SHARED_SEARCH_SOURCES pairs share the target they are routed
+        together with a single search from the target over the reversed
+        graph.
+        Params:
+            - pairs: A list of (source, target) tuples of node ids.
+        Returns a list with the node path of each pair, None if there is no
+        path.
+        '''
+        sources = collections.defaultdict(list)
+        for source, target in pairs:
+            sources[target].append(source)
+
+        paths = {}
+        for target in sources.keys():
+            if len(sources[target]) < SHARED_SEARCH_SOURCES:
+                for source in sources[target]:
+                    try:
+                        paths[(source, target)] = nx.shortest_path(
+                            self._igraph, source=source, target=target,
+                            weight='itime')
+                    except nx.NetworkXNoPath:
+                        paths[(source, target)] = None
+            else:
+                target_paths = self._route_to_target(sources[target], target)
+                for source in sources[target]:
+                    paths[(source, target)] = target_paths[source]
+        return [paths[pair] for pair in pairs]
+
+    def _route_to_target(self, sources, target):
+        '''
+        Computes the shortest paths from several sources to a target with a
+        single Dijkstra search from the target over the reversed edges, which
+        stops as soon as every source is reached.
+        Params:
+            - sources: A list of node ids.
+            - target: A node id.
+        Returns a dictionary mapping each source to its node path, None if
+        there is no path.
+        '''
+        pending = set(sources)
+        dist = {target: 0}
+        next_node = {}  # The next node towards the target
+        settled = set()
+        heap = [(0, target)]
+        while heap and pending:
+            d, v = heapq.heappop(heap)
+            if v in settled:
+                continue
+            settled.add(v)
+            pending.discard(v)
+            for u, edge_info in self._igraph.pred[v].items():
+                new_dist = d + edge_info['itime']
+                if u not in dist or new_dist < dist[u]:
+                    dist[u] = new_dist
+                    next_node[u] = v
+                    heapq.heappush(heap, (new_dist, u))
+
+        paths = {}
+        for source in sources:
+            if source not in settled:
+                paths[source] = None
+                continue
+            path = [source]
+            while path[-1] != target:
+                path.append(next_node[path[-1]])
+            paths[source] = path
+        return paths
 
     def get_location_map(self, location, filename):
         '''
@@ -103,71 +594,129 @@ class iGraph:
 
     def plot_graph(self, save=True):
         '''
-        Plots igraph.
+        Plots igraph. Only available when the graph is not partitioned.
         Params:
             - save = True: A boolean that determines whether the resulting
             image should be saved.
         This function does not return anything.
         '''
+        if self._overlay is not None:
+            raise ValueError("The graph can't be plotted in partitioned mode")
         multiGraph = nx.MultiDiGraph(self._igraph)
         ox.plot_graph(multiGraph, node_size=0, save=save,
                       filepath=IMAGE_FILENAME)
 
     # Functions for input / output
 
-    def _get_graph(self):
+    def _project_highways(self, graph, highways):
         '''
-        Gets the graph of the streets from cache or downloads it from the
-        internet if necessary.
-        Returns the obtained graph.
+        Converts highways format from coordinates to node ids.
+        Params:
+            - graph: The graph obtained by cache or downloaded.
+            - highways: The Highways with the coordinates of their points.
+        Returns an array with the node id of each point of the highways.
         '''
-        # load/download graph (using cache) and plot it on the screen
-        if not self._exists_file(GRAPH_FILENAME):
-            graph = self._download_graph(PLACE)
-            self._save_dict(graph, GRAPH_FILENAME)
-            print("Graph generated")
-        else:
-            graph = self._load_dict(GRAPH_FILENAME)
-            print("Graph loaded")
-        return graph
+        print("Proyecting highways...")
+        return np.concatenate(
+            _parallel_map(_project_highways_chunk, graph, highways.coords))
 
-    def _get_highways(self, graph):
+    def _map_highways(self, graph, highways, nodes):
         '''
-        Gets the highways from cache or downloads them from the internet if
-        necessary.
+        Maps the highways to the edges of the graph they cover.
         Params:
             - graph: The graph obtained by cache or downloaded.
-        Returns the obtained highways.
-        '''
-        # load/download graph (using cache) and plot it on the screen
-        if not self._exists_file(HIGHWAYS_FILENAME):
-            highways_coords = self._download_highways(HIGHWAYS_URL)
-            highways = self._project_highways(graph, highways_coords)
-            self._save_dict(highways, HIGHWAYS_FILENAME)
-            print("Highways generated")
-        else:
-            highways = self._load_dict(HIGHWAYS_FILENAME)
-            print("Highways loaded")
-        return highways
+            - highways: The Highways with the coordinates of their points.
+            - nodes: An array with the node id of each point of the highways.
+        Returns the resulting HighwaysEdges.
+        '''
+        print("Mapping highways...")
+        highways_nodes = np.split(nodes, highways.offsets[1:-1])
+        edges = []
+        for chunk_edges in _parallel_map(_map_highways_chunk, graph,
+                                         highways_nodes):
+            edges.extend(chunk_edges)
+        return self._get_highways_edges(highways.way_id, edges)
 
-    def _project_highways(self, graph, highways_coords):
+    def _get_highways_edges(self, way_id, edges):
         '''
-        Converts highways format from coordinates to node ids.
+        Packs the edges covered by each highway as arrays.
         Params:
-            - graph: The graph obtained by cache or downloaded.
-            - highways_coords: The highways formatted its id and its
-            coordinates.
-        Returns the highways formatted as its id and its node id's
+            - way_id: An array with the id of each highway.
+            - edges: A list with the list of edges of each highway.
+        Returns the resulting HighwaysEdges.
         '''
-        print("Proyecting highways...")
-        highways = {}
-        for key in highways_coords.keys():
-            coords = list(highways_coords[key].coords.coords)
-            coordsY = [coords[i][1] for i in range(len(coords))]
-            coordsX = [coords[i][0] for i in range(len(coords))]
-            nodes = ox.get_nearest_nodes(graph, coordsX, coordsY)
-            highways[key] = nodes
-        return highways
+        offsets = np.zeros(len(edges) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(e) for e in edges])
+        return HighwaysEdges(
+            way_id, offsets,
+            np.array([edge for e in edges for edge in e],
+                     dtype=np.int64).reshape(-1, 2))
+
+    def _get_actual(self, way_id, congestions):
+        '''
+        Gets the actual congestion of the given highways.
+        Params:
+            - way_id: An array with the ids of the highways.
+            - congestions: The Congestions available.
+        Returns an array with the actual congestion of each highway, 0 ("No
+        data") for the highways without congestions.
+        '''
+        actual = np.zeros(len(way_id), dtype=np.int8)
+        if len(congestions.way_id) > 0:
+            index = np.minimum(np.searchsorted(congestions.way_id, way_id),
+                               len(congestions.way_id) - 1)
+            found = congestions.way_id[index] == way_id
+            actual[found] = congestions.actual[index[found]]
+        return actual
+
+    def _get_hash(self, value):
+        '''
+        Computes the content hash of the given value.
+        Params:
+            - value: Any picklable value.
+        Returns a string with the hash.
+        '''
+        return hashlib.sha256(pickle.dumps(value)).hexdigest()
+
+    def _run_stage(self, stage, function, *inputs):
+        '''
+        Runs a stage of the build, or loads its artifact from cache if it was
+        already computed from inputs with the same content. Only the latest
+        artifact of each stage is kept, so stages should only have inputs
+        that rarely change.
+        Params:
+            - stage: A string with the name of the stage.
+            - function: The function computing the artifact from the inputs.
+            - inputs: A tuple with the content hash and the value of each
+            input.
+        Returns a tuple with the content hash and the artifact.
+        '''
+        key = hashlib.sha256(' '.join(
+            [str(CACHE_VERSION), stage] + [h for h, value in inputs]).encode()
+        ).hexdigest()
+        filename = os.path.join(CACHE_DIRNAME, '%s-%s.pickle' % (stage, key))
+        if self._exists_file(filename):
+            print("Stage", stage, "loaded")
+            return self._load_dict(filename)
+
+        artifact = function(*[value for h, value in inputs])
+        result = (self._get_hash(artifact), artifact)
+        os.makedirs(CACHE_DIRNAME, exist_ok=True)
+        self._save_dict(result, filename)
+
+        # Remove the artifacts of the stage computed from other inputs, which
+        # other processes may be removing as well
+        for old_filename in os.listdir(CACHE_DIRNAME):
+            old_filename = os.path.join(CACHE_DIRNAME, old_filename)
+            if os.path.basename(old_filename).startswith(stage + '-') and \
+                    old_filename.endswith('.pickle') and \
+                    old_filename != filename:
+                try:
+                    os.remove(old_filename)
+                except FileNotFoundError:
+                    pass
+        print("Stage", stage, "generated")
+        return result
 
     def _exists_file(self, filename):
         '''
@@ -207,8 +756,13 @@ class iGraph:
             the graph.
         This function does not return anything.
         '''
-        with open(filename, 'wb') as file:
+        # Write to a temporary file first so readers never see it half done.
+        # It is unique, since several processes may save the same file.
+        tmp_filename = '%s.%d.%d.tmp' % (filename, os.getpid(),
+                                         threading.get_ident())
+        with open(tmp_filename, 'wb') as file:
             pickle.dump(dictionary, file)
+        os.replace(tmp_filename, filename)
 
     def _load_dict(self, filename):
         '''
@@ -221,18 +775,15 @@ class iGraph:
             dictionary = pickle.load(file)
         return dictionary
 
-    def _get_line_string_from_coords(self, coords):
+    def _get_coords_from_string(self, coords):
         '''
-        Converts a string with coordinates separated by comas to linestring.
+        Converts a string with coordinates separated by comas to an array.
         Params:
             - coords: A string containing the aforementioned coma separated
             coordinates.
-        Returns the resulting linestring.
+        Returns an array with a (lon, lat) row for each point.
         '''
-        coords = coords.split(",")
-        coords = [(float(coords[i]), float(coords[i+1]))
-                  for i in range(0, len(coords), 2)]
-        return LineString(coords)
+        return np.array(coords.split(","), dtype=np.float64).reshape(-1, 2)
 
     def _download_highways(self, url):
         '''
@@ -240,7 +791,7 @@ class iGraph:
         Params:
             - url: A string containing the url the highways should be
             downloaded from.
-        Returns a dictionary mapping the ids to the obtained highways.
+        Returns the obtained Highways.
         '''
         print("Downloading highways...")
         done = False
@@ -254,12 +805,21 @@ class iGraph:
             except:
                 print("Download failed!!! Retrying...")
 
-        highways = {}
+        way_ids, descriptions, coords = [], [], []
         for line in reader:
             way_id, description, coordinates = line
-            highways[int(way_id)] = Highway(
-                description, self._get_line_string_from_coords(coordinates))
-        return highways
+            way_ids.append(int(way_id))
+            descriptions.append(description)
+            coords.append(self._get_coords_from_string(coordinates))
+
+        order = np.argsort(way_ids, kind='stable')
+        offsets = np.zeros(len(order) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(coords[i]) for i in order])
+        return Highways(
+            np.array(way_ids, dtype=np.int64)[order],
+            np.array(descriptions, dtype=object)[order], offsets,
+            np.concatenate([coords[i] for i in order] +
+                           [np.zeros((0, 2))]).reshape(-1, 2))
 
     def _download_congestions(self, url):
         '''
@@ -267,7 +827,7 @@ class iGraph:
         Params:
             - url: A string containing the url the congestions should be
             downloaded from.
-        Returns a dictionary mapping the ids to the obtained congestions.
+        Returns the obtained Congestions.
         '''
         print("Downloading congestions...")
         done = False
@@ -275,18 +835,83 @@ class iGraph:
             try:
                 with urllib.request.urlopen(url) as response:
                     lines = [l.decode('utf-8') for l in response.readlines()]
-                reader = csv.reader(lines, delimiter='#', quotechar='"')
                 done = True
             except:
                 print("Download failed!!! Retrying...")
+        return self._parse_congestions(lines)
 
-        congestions = {}
-        for line in reader:
-            line = list(map(int, line))
-            way_id, date, actual, predicted = line
-            if way_id not in congestions.keys() or \
-                    congestions[way_id].date < date:
-                congestions[way_id] = Congestion(date, actual, predicted)
+    def _parse_congestions(self, lines):
+        '''
+        Parses the congestions from the lines of the congestions file.
+        Params:
+            - lines: A list of strings with the rows of the file.
+        Returns the Congestions sorted by highway, with only the latest row of
+        each highway.
+        '''
+        rows = np.loadtxt(lines, delimiter='#', comments=None,
+                          dtype=np.int64, ndmin=2).reshape(-1, 4)
+
+        # Keep only the latest row of each highway
+        rows = rows[np.lexsort((rows[:, 1], rows[:, 0]))]
+        latest = np.ones(len(rows), dtype=bool)
+        latest[:-1] = rows[1:, 0] != rows[:-1, 0]
+        rows = rows[latest]
+        return Congestions(rows[:, 0], rows[:, 1], rows[:, 2].astype(np.int8),
+                           rows[:, 3].astype(np.int8))
+
+    def _get_history_filename(self, timestamp):
+        '''
+        Gets the file of the history that stores the given snapshot. Snapshots
+        are partitioned in a directory for each day.
+        Params:
+            - timestamp: An integer formatted as YYYYMMDDhhmmss.
+        Returns a string with the name of the file.
+        '''
+        return os.path.join(HISTORY_DIRNAME, str(timestamp)[:8],
+                            '%d.npz' % timestamp)
+
+    def _save_congestions(self, congestions):
+        '''
+        Appends the congestions to the history as columnar arrays, unless the
+        snapshot is already stored.
+        Params:
+            - congestions: The Congestions to save.
+        This function does not return anything.
+        '''
+        if len(congestions.way_id) == 0:
+            return
+        timestamp = int(congestions.date.max())
+        filename = self._get_history_filename(timestamp)
+        if self._exists_file(filename):
+            return
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        # Write to a temporary file first so replays never see it half done.
+        # It is unique, since several processes may save the same snapshot.
+        tmp_filename = '%s.%d.%d.tmp' % (filename, os.getpid(),
+                                         threading.get_ident())
+        with open(tmp_filename, 'wb') as file:
+            np.savez_compressed(file, **congestions._asdict())
+        os.replace(tmp_filename, filename)
+        print("Congestions saved on", filename)
+
+    def _load_congestions(self, timestamp):
+        '''
+        Loads from the history the latest congestions at or before the given
+        timestamp.
+        Params:
+            - timestamp: An integer formatted as YYYYMMDDhhmmss.
+        Returns the stored Congestions.
+        '''
+        timestamps = [t for t in get_history_timestamps() if t <= timestamp]
+        if not timestamps:
+            raise ValueError("No congestions stored before %d" % timestamp)
+        filename = self._get_history_filename(timestamps[-1])
+        with np.load(filename) as data:
+            # Older snapshots are not sorted by way_id
+            order = np.argsort(data['way_id'], kind='stable')
+            congestions = Congestions(**{field: data[field][order]
+                                         for field in Congestions._fields})
+        print("Congestions loaded from", filename)
         return congestions
 
     def _generate_map(self, path, filename):
@@ -329,6 +954,400 @@ class iGraph:
             coords_path.append(Location(node_info['x'], node_info['y']))
         return coords_path
 
+    # Functions for the partitioned graph
+
+    def _get_cell(self, location):
+        '''
+        Gets the cell of the partition that contains the given location.
+        Params:
+            - location: A Location.
+        Returns a tuple of two integers identifying the cell.
+        '''
+        return (int(math.floor(location.lon / CELL_SIZE)),
+                int(math.floor(location.lat / CELL_SIZE)))
+
+    def _get_cell_filename(self, cell):
+        '''
+        Gets the name of the file that stores the given cell.
+        Params:
+            - cell: A tuple of two integers identifying the cell.
+        Returns a string with the name of the file.
+        '''
+        return os.path.join(CELLS_DIRNAME, '%d_%d.cell' % cell)
+
+    def _get_node_location(self, graph, node):
+        '''
+        Gets the location of a node of the given graph.
+        Params:
+            - graph: A graph containing the node.
+            - node: The id of the node.
+        Returns the location of the node.
+        '''
+        node_info = graph.nodes[node]
+        return Location(node_info['x'], node_info['y'])
+
+    def _get_overlay(self, congestions):
+        '''
+        Gets the overlay of the partition from cache or builds the whole
+        partition, downloading the graph of the metropolitan area, if
+        necessary. In both cases the cells are customized with the given
+        congestions.
+        Params:
+            - congestions: The Congestions available.
+        Returns the obtained overlay.
+        '''
+        if not self._exists_file(OVERLAY_FILENAME):
+            graph = self._download_graph(METRO_PLACE)
+            highways = self._download_highways(HIGHWAYS_URL)
+            nodes = self._project_highways(graph, highways)
+            self._split_graph(
+                graph, self._map_highways(graph, highways, nodes))
+            del graph
+            overlay, cells = self._customize_partition(congestions)
+            print("Partition generated")
+        else:
+            overlay = self._load_dict(OVERLAY_FILENAME)
+            print("Partition loaded")
+            # The cells may have been customized with older congestions
+            overlay, cells = self._customize_partition(congestions, overlay)
+        return overlay
+
+    def _pack_lists(self, lists):
+        '''
+        Packs a list of lists of integers as two arrays.
+        Params:
+            - lists: The list of lists.
+        Returns a tuple with the offsets of each list and their values.
+        '''
+        offsets = np.zeros(len(lists) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(values) for values in lists])
+        return offsets, np.array([value for values in lists
+                                  for value in values], dtype=np.int64)
+
+    def _unpack_lists(self, offsets, values):
+        '''
+        Unpacks a list of lists of integers packed with _pack_lists.
+        Params:
+            - offsets: The array with the offsets of each list.
+            - values: The array with their values.
+        Returns the list of lists.
+        '''
+        offsets = offsets.tolist()
+        values = values.tolist()
+        return [values[offsets[i]:offsets[i+1]]
+                for i in range(len(offsets) - 1)]
+
+    def _split_graph(self, graph, highways_edges):
+        '''
+        Splits the graph in square cells and stores each of them on disk.
+        Each cell keeps its nodes, the edges leaving them and its boundary
+        nodes. The skeleton of the whole graph, with just the ids of its
+        edges, their adjacency and the edges covered by each highway, is
+        stored as well, so that congestions can be estimated over the whole
+        area exactly as in the unpartitioned graph.
+        Params:
+            - graph: The graph of the streets of the whole area.
+            - highways_edges: The HighwaysEdges covered by the highways.
+        This function does not return anything.
+        '''
+        print("Splitting graph...")
+        os.makedirs(CELLS_DIRNAME, exist_ok=True)
+        node_cells = {node: self._get_cell(self._get_node_location(graph,
+                                                                   node))
+                      for node in graph.nodes}
+        cells = collections.defaultdict(list)
+        for node, cell in node_cells.items():
+            cells[cell].append(node)
+        cells_list = sorted(cells.keys())
+        cell_index = {cell: i for i, cell in enumerate(cells_list)}
+
+        # Edges are identified by their position, and each one belongs to
+        # the cell of its source node
+        edges = list(graph.edges)
+        index = {edge: i for i, edge in enumerate(edges)}
+        in_edges, out_edges = self._get_adjacency(graph, edges)
+        in_offsets, in_ids = self._pack_lists(in_edges)
+        out_offsets, out_ids = self._pack_lists(out_edges)
+        self._save_dict({
+            'edges': np.array(edges, dtype=np.int64).reshape(-1, 2),
+            'in_offsets': in_offsets, 'in_edges': in_ids,
+            'out_offsets': out_offsets, 'out_edges': out_ids,
+            'cells': cells_list,
+            'edge_cells': np.array([cell_index[node_cells[u]]
+                                    for u, v in edges], dtype=np.int64),
+            'way_id': highways_edges.way_id,
+            'highways_offsets': highways_edges.offsets,
+            'highways_edges': np.array(
+                [index[(u, v)] for u, v in highways_edges.edges.tolist()],
+                dtype=np.int64)}, SKELETON_FILENAME)
+
+        for cell, nodes in cells.items():
+            cell_graph = nx.DiGraph()
+            cell_graph.graph.update(graph.graph)
+            cell_graph.add_nodes_from(nodes)
+            cell_graph.add_edges_from(graph.out_edges(nodes, data=True))
+            for node in cell_graph.nodes:
+                cell_graph.nodes[node].update(graph.nodes[node])
+
+            # Boundary nodes are reached from or lead to other cells
+            entries = [v for v in nodes if any(
+                node_cells[u] != cell for u in graph.predecessors(v))]
+            exits = [u for u in nodes if any(
+                node_cells[v] != cell for v in graph.successors(u))]
+
+            self._save_dict({'graph': cell_graph, 'nodes': nodes,
+                             'entries': entries, 'exits': exits,
+                             'edges': np.array(
+                                 [index[edge] for edge in cell_graph.edges],
+                                 dtype=np.int64)},
+                            self._get_cell_filename(cell))
+
+    def _customize_partition(self, congestions, overlay=None):
+        '''
+        Estimates the congestions of the whole area on the skeleton and
+        computes the itimes of the cells whose congestions have changed, one
+        at a time, and the overlay that connects the boundary nodes of every
+        cell.
+        Params:
+            - congestions: The Congestions available.
+            - overlay = None: The current overlay. If None, every cell is
+            customized and the overlay is built from scratch. Otherwise it is
+            not modified, a copy is updated instead.
+        Returns a tuple with the resulting overlay and the list of customized
+        cells.
+        '''
+        print("Customizing partition...")
+        skeleton = self._load_dict(SKELETON_FILENAME)
+
+        # Assign the congestion data we do have
+        congestion = np.zeros(len(skeleton['edges']), dtype=np.int8)
+        known = np.zeros(len(skeleton['edges']), dtype=bool)
+        actual = self._get_actual(skeleton['way_id'], congestions)
+        offsets = skeleton['highways_offsets']
+        for i in np.flatnonzero(actual > 0):
+            edges = skeleton['highways_edges'][offsets[i]:offsets[i+1]]
+            congestion[edges] = actual[i]
+            known[edges] = True
+
+        # Estimate the missing congestions over the whole area
+        congestion = np.array(_estimate_congestions(
+            self._unpack_lists(skeleton['in_offsets'], skeleton['in_edges']),
+            self._unpack_lists(skeleton['out_offsets'],
+                               skeleton['out_edges']),
+            congestion.tolist()), dtype=np.int8)
+
+        if overlay is None:
+            cells = skeleton['cells']
+            overlay = nx.DiGraph()
+        else:
+            changed = np.flatnonzero(congestion != overlay.graph['congestion'])
+            cells = [skeleton['cells'][i] for i in
+                     np.unique(skeleton['edge_cells'][changed]).tolist()]
+            if not cells:
+                return overlay, cells
+            overlay = overlay.copy()
+
+        for cell in cells:
+            self._customize_cell(cell, overlay, skeleton['edges'],
+                                 congestion, known)
+
+        # The congestions the cells are customized with
+        overlay.graph['congestion'] = congestion
+        self._save_dict(overlay, OVERLAY_FILENAME)
+        return overlay, cells
+
+    def _customize_cell(self, cell, overlay, edges, congestion, known):
+        '''
+        Computes the itimes of a cell and replaces its edges in the overlay.
+        Params:
+            - cell: A tuple of two integers identifying the cell.
+            - overlay: The overlay to update.
+            - edges: The array with the edges of the skeleton.
+            - congestion: The array with the congestion of each edge of the
+            skeleton.
+            - known: The array that tells whether the congestion of each edge
+            of the skeleton is known.
+        This function does not return anything.
+        '''
+        filename = self._get_cell_filename(cell)
+        data = self._load_dict(filename)
+        graph = data['graph']
+        for i, (u, v) in zip(data['edges'].tolist(),
+                             edges[data['edges']].tolist()):
+            graph[u][v]['congestion'] = int(congestion[i])
+            graph[u][v]['congestionInfo'] = bool(known[i])
+        graph = self._get_igraph(graph)
+        self._save_dict(data, filename)
+
+        for node in data['entries'] + data['exits']:
+            overlay.add_node(node, **graph.nodes[node])
+
+        # Remove the previous edges of the cell
+        nodes = set(data['nodes'])
+        for u in data['entries']:
+            for v in list(overlay.successors(u)):
+                if overlay[u][v].get('cell') == cell:
+                    overlay.remove_edge(u, v)
+        for u in data['exits']:
+            for v in list(overlay.successors(u)):
+                if v not in nodes and 'cell' not in overlay[u][v]:
+                    overlay.remove_edge(u, v)
+
+        # Shortest paths across the cell between its boundary nodes
+        internal = graph.subgraph(data['nodes'])
+        for u in data['entries']:
+            lengths = nx.single_source_dijkstra_path_length(
+                internal, u, weight='itime')
+            for v in data['exits']:
+                if v != u and lengths.get(v, float('inf')) < float('inf'):
+                    overlay.add_edge(u, v, itime=lengths[v], cell=cell)
+
+        # Edges between this cell and the adjacent ones
+        for u in data['exits']:
+            for v, edge_info in graph[u].items():
+                if v not in nodes:
+                    overlay.add_edge(u, v, itime=edge_info['itime'])
+
+    def _get_cell_data(self, cell):
+        '''
+        Gets the given cell of the partition, loading it from disk if it is
+        not in memory. Only the MAX_LOADED_CELLS most recently used cells are
+        kept in memory.
+        Params:
+            - cell: A tuple of two integers identifying the cell.
+        Returns the data of the cell, None if the cell has no nodes.
+        '''
+        with self._cells_lock:
+            if cell in self._cells:
+                self._cells.move_to_end(cell)
+                return self._cells[cell]
+            generation = self._cells_generations[cell]
+        filename = self._get_cell_filename(cell)
+        if not self._exists_file(filename):
+            return None
+        data = self._load_dict(filename)
+        with self._cells_lock:
+            # If the cell has been customized meanwhile the data may be old,
+            # so it is used but not kept
+            if self._cells_generations[cell] == generation:
+                self._cells[cell] = data
+                if len(self._cells) > MAX_LOADED_CELLS:
+                    self._cells.popitem(last=False)
+        return data
+
+    def _snap_to_partition(self, location):
+        '''
+        Gets the node of the partition nearest to the given location.
+        Params:
+            - location: The Location to snap.
+        Returns a tuple with the id and the location of the node, None if
+        neither the cell of the location nor the adjacent ones have nodes.
+        '''
+        # The adjacent cells are only searched if they are closer than the
+        # nearest node found so far
+        x, y = self._get_cell(location)
+        cells = [(x + dx, y + dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1)]
+        cells.sort(key=lambda cell: self._get_cell_distance(location, cell))
+        nearest = None
+        for cell in cells:
+            if nearest is not None and \
+                    self._get_cell_distance(location, cell) >= nearest[0]:
+                break
+            data = self._get_cell_data(cell)
+            if data is None:
+                continue
+            graph = data['graph']
+            node = ox.get_nearest_nodes(
+                graph, [location.lon], [location.lat])[0]
+            node_loc = self._get_node_location(graph, node)
+            dist = ox.distance.great_circle_vec(
+                location.lat, location.lon, node_loc.lat, node_loc.lon)
+            if nearest is None or dist < nearest[0]:
+                nearest = (dist, node, node_loc)
+        if nearest is None:
+            return None
+        return nearest[1], nearest[2]
+
+    def _get_cell_distance(self, location, cell):
+        '''
+        Computes the distance from a location to the nearest point of a cell.
+        Params:
+            - location: A Location.
+            - cell: A tuple of two integers identifying the cell.
+        Returns the distance in meters, 0 if the cell contains the location.
+        '''
+        west, south = cell[0] * CELL_SIZE, cell[1] * CELL_SIZE
+        lon = min(max(location.lon, west), west + CELL_SIZE)
+        lat = min(max(location.lat, south), south + CELL_SIZE)
+        return ox.distance.great_circle_vec(
+            location.lat, location.lon, lat, lon)
+
+    def _get_partition_path(self, source_loc, target_loc):
+        '''
+        Computes the shortest path between the two specified locations using
+        only the cells of the source and the target and the overlay. The
+        overlay edges of the resulting path are unpacked with the cells they
+        cross.
+        Params:
+            - source_loc: A location with the source of the path.
+            - target_loc: A location with the target of the path.
+        Returns a tuple with the itime and the list of locations along the
+        resulting path, if there is no path None is returned.
+        '''
+        source = self._snap_to_partition(source_loc)
+        target = self._snap_to_partition(target_loc)
+        if source is None or target is None:
+            return None
+        source, source_loc = source
+        target, target_loc = target
+
+        graphs = [self._overlay]
+        for cell in {self._get_cell(source_loc), self._get_cell(target_loc)}:
+            data = self._get_cell_data(cell)
+            if data is not None:
+                graphs.append(data['graph'])
+
+        # Dijkstra over the union of the graphs
+        dist = {source: 0}
+        prev = {}
+        heap = [(0, source)]
+        while heap:
+            d, u = heapq.heappop(heap)
+            if u == target:
+                break
+            if d > dist[u]:
+                continue
+            for graph in graphs:
+                if u in graph:
+                    for v, edge_info in graph[u].items():
+                        new_dist = d + edge_info['itime']
+                        if new_dist < dist.get(v, float('inf')):
+                            dist[v] = new_dist
+                            prev[v] = (u, graph)
+                            heapq.heappush(heap, (new_dist, v))
+        if target not in dist:
+            return None
+
+        # Unpack the path from the target to the source
+        coords_path = []
+        node = target
+        while node != source:
+            u, graph = prev[node]
+            if 'cell' in graph[u][node]:
+                data = self._get_cell_data(graph[u][node]['cell'])
+                internal = data['graph'].subgraph(data['nodes'])
+                inner_path = nx.shortest_path(
+                    internal, source=u, target=node, weight='itime')
+                for inner_node in reversed(inner_path[1:]):
+                    coords_path.append(
+                        self._get_node_location(internal, inner_node))
+            else:
+                coords_path.append(self._get_node_location(graph, node))
+            node = u
+        coords_path.append(source_loc)
+        coords_path.reverse()
+        return dist[target], coords_path
+
     # Functions for building the iGraph
 
     def _update_igraph(self):
@@ -340,31 +1359,41 @@ class iGraph:
         threading.Timer(300, self._update_igraph).start()
         print("Updating...")
         oldCongestions = self._congestions
-        highways = self._highways
         congestions = self._download_congestions(CONGESTIONS_URL)
+        self._save_congestions(congestions)
+        self._congestions = congestions
+
+        if self._overlay is not None:
+            # Customize again the cells whose congestions have changed
+            overlay, cells = self._customize_partition(
+                congestions, self._overlay)
+            if cells:
+                with self._cells_lock:
+                    self._overlay = overlay
+                    for cell in cells:
+                        self._cells_generations[cell] += 1
+                        self._cells.pop(cell, None)
+                print("Done")
+            return
+
         graph = self._igraph
+        highways_edges = self._highways_edges
+
+        # If nothing has changed there is nothing to update, so only the
+        # highways whose congestion has changed are visited
+        actual = self._get_actual(highways_edges.way_id, congestions)
+        changed = np.flatnonzero(
+            actual != self._get_actual(highways_edges.way_id, oldCongestions))
 
         anyUpdate = False
-        for key in congestions.keys():
-            # If nothing has changed there is nothing to update
-            if congestions[key].actual != oldCongestions[key].actual:
-                # Nodes is the list of nodes of the corresponding highway
-                nodes = self._highways[key]
-                for i in range(1, len(nodes)):
-                    # For each segment of the highway assign the congestion to
-                    # the shortest path between the nodes that it connects.
-                    if (nx.has_path(graph, source=nodes[i-1],
-                                    target=nodes[i])):
-                        # Path is the aforementioned shortest path.
-                        path = nx.shortest_path(
-                            graph, source=nodes[i-1], target=nodes[i],
-                            weight='length')
-                        for i in range(1, len(path)):
-                            graph[path[i-1]][path[i]]['congestion'] = \
-                                congestions[key].actual
-                            graph[path[i-1]][path[i]]['congestionInfo'] = \
-                                (congestions[key].actual > 0)
-                            anyUpdate = True
+        for i in changed:
+            # Assign the congestion to the edges covered by the highway
+            edges = highways_edges.edges[
+                highways_edges.offsets[i]:highways_edges.offsets[i+1]]
+            for u, v in edges.tolist():
+                graph[u][v]['congestion'] = int(actual[i])
+                graph[u][v]['congestionInfo'] = bool(actual[i] > 0)
+                anyUpdate = True
 
         # If there has been an update the estimations and the itime need to be
         # recomputed
@@ -427,89 +1456,100 @@ class iGraph:
             - graph: The graph whose congestions should be estimated.
         Returns the resulting graph.
         '''
-        # For each iteration for each node extend the average congestion of
-        # the adjacent
-        # streets with known congestion to the adjacent streets with unknown
-        # congestion.
-        for iteration in range(6):
-            for node1, info1 in graph.nodes.items():
-                congestionSum = 0
-                congestionCount = 0
-                for u, v, data in graph.in_edges(node1, data=True):
-                    if data['congestion'] > 0:
-                        congestionSum += data['congestion']
-                        congestionCount += 1
-                for u, v, data in graph.out_edges(node1, data=True):
-                    if data['congestion'] > 0:
-                        congestionSum += data['congestion']
-                        congestionCount += 1
-                if congestionCount > 0:
-                    averageCongestion = congestionSum//congestionCount
-                    for u, v, data in graph.in_edges(node1, data=True):
-                        if data['congestion'] == 0:
-                            graph[u][v]['congestion'] = max(
-                                1, averageCongestion-1)
-                    for u, v, data in graph.out_edges(node1, data=True):
-                        if data['congestion'] == 0:
-                            graph[u][v]['congestion'] = max(
-                                1, averageCongestion)
-
-        # The remaining streets are very isolated so we can assume there won't
-        # be many people using them.
-        for node1, info1 in graph.nodes.items():
-            for u, v, data in graph.in_edges(node1, data=True):
-                if data['congestion'] == 0:
-                    graph[u][v]['congestion'] = 1
-
+        edges = list(graph.edges)
+        in_edges, out_edges = self._get_adjacency(graph, edges)
+        congestion = _estimate_congestions(
+            in_edges, out_edges,
+            [graph[u][v]['congestion'] for u, v in edges])
+        for (u, v), edge_congestion in zip(edges, congestion):
+            graph[u][v]['congestion'] = edge_congestion
         return graph
 
-    def _build_igraph(self, graph, highways, congestions):
+    def _get_adjacency(self, graph, edges):
         '''
-        Builds the igraph from the graph of the streets, the highways and the
-        congestion data available.
+        Gets the ids of the edges entering and leaving each node.
         Params:
-            - graph: The graph of the streets.
-            - highways: A dictionary that maps the ids with the highways.
-            - congestions: A dictionary that maps the ids with the congestions.
-        Returns the resulting igraph.
+            - graph: A graph.
+            - edges: The list of edges of the graph, whose positions are
+            their ids.
+        Returns a tuple with the lists of ids of the in edges and of the out
+        edges of each node, in the order of the nodes of the graph.
         '''
-        print("Building iGraph...")
+        index = {edge: i for i, edge in enumerate(edges)}
+        in_edges = [[index[(u, node)] for u in graph.pred[node]]
+                    for node in graph.nodes]
+        out_edges = [[index[(node, v)] for v in graph.succ[node]]
+                     for node in graph.nodes]
+        return in_edges, out_edges
 
+    def _propagate_congestions(self, graph, highways_edges, congestions):
+        '''
+        Assigns the congestion data available to the edges covered by each
+        highway and estimates the missing congestions.
+        Params:
+            - graph: The graph of the streets.
+            - highways_edges: The HighwaysEdges covered by the highways.
+            - congestions: The Congestions available.
+        Returns the resulting graph.
+        '''
         # Initialize the congestion to "No data"
         nx.set_edge_attributes(graph, 0, 'congestion')
         nx.set_edge_attributes(graph, False, 'congestionInfo')
 
-        # Assign the congestion data we do have
-        for key in congestions.keys():
-            # If our data about the congestion is just "No data" it's useless.
-            if congestions[key].actual > 0:
-                # nodes is the list of nodes of the corresponding highway
-                nodes = highways[key]
-
-                for i in range(1, len(nodes)):
-                    # For each segment of the highway assign the congestion to
-                    # the shortest path between the nodes that it connects.
-                    if (nx.has_path(graph, source=nodes[i-1],
-                                    target=nodes[i])):
-                        # Path is the aforementioned shortest path.
-                        path = nx.shortest_path(
-                            graph, source=nodes[i-1], target=nodes[i],
-                            weight='length')
-                        for i in range(1, len(path)):
-                            graph[path[i-1]][path[i]]['congestion'] = \
-                                congestions[key].actual
-                            graph[path[i-1]][path[i]]['congestionInfo'] = True
+        # Assign the congestion data we do have. If our data about the
+        # congestion is just "No data" it's useless.
+        actual = self._get_actual(highways_edges.way_id, congestions)
+        for i in np.flatnonzero(actual > 0):
+            edges = highways_edges.edges[
+                highways_edges.offsets[i]:highways_edges.offsets[i+1]]
+            for u, v in edges.tolist():
+                graph[u][v]['congestion'] = int(actual[i])
+                graph[u][v]['congestionInfo'] = True
 
         print("Filling congestions...")
 
         # Estimate the missing congestions
-        graph = self._estimate_missing_congestions(graph)
+        return self._estimate_missing_congestions(graph)
+
+    def _build_igraph(self, congestions):
+        '''
+        Builds the igraph in stages: download of the graph and the highways,
+        snapping of the highways, mapping of the highways to edges,
+        propagation of the congestions and itimes. Independent work runs in
+        parallel. The artifacts of the stages that do not depend on the
+        congestions are cached, so only the stages depending on a changed
+        input are recomputed. Propagation and itimes change with every
+        download of congestions, so they are always computed in memory.
+        Params:
+            - congestions: The Congestions available.
+        Returns a tuple with the HighwaysEdges covered by the highways and the
+        resulting igraph.
+        '''
+        print("Building iGraph...")
+
+        # Both downloads are independent, so they run at the same time
+        with multiprocessing.pool.ThreadPool(2) as pool:
+            graph_stage = pool.apply_async(
+                self._run_stage,
+                ('graph', self._download_graph, (PLACE, PLACE)))
+            highways_stage = pool.apply_async(
+                self._run_stage,
+                ('highways', self._download_highways,
+                 (HIGHWAYS_URL, HIGHWAYS_URL)))
+            graph = graph_stage.get()
+            highways = highways_stage.get()
+
+        nodes = self._run_stage(
+            'snap', self._project_highways, graph, highways)
+        highways_edges = self._run_stage(
+            'mapping', self._map_highways, graph, highways, nodes)
+        graph = self._propagate_congestions(
+            graph[1], highways_edges[1], congestions)
 
         print("Declaring iTimes...")
 
-        # Compute the itime of every street
         igraph = self._get_igraph(graph)
 
         print("Done")
 
-        return igraph
+        return highways_edges[1], igraph
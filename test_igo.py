@@ -0,0 +1,409 @@
+import threading
+import time
+
+import networkx as nx
+import numpy as np
+import pytest
+
+import igo
+from igo import _Batcher
+
+
+def make_graph(size=10, spacing=0.005, seed=0):
+    '''
+    Builds a grid of streets in both directions with random lengths.
+    '''
+    rng = np.random.default_rng(seed)
+    graph = nx.DiGraph(crs='epsg:4326')
+    for i in range(size):
+        for j in range(size):
+            graph.add_node(i * size + j, x=2.1 + i * spacing,
+                           y=41.3 + j * spacing)
+    for i in range(size):
+        for j in range(size):
+            for di, dj in [(0, 1), (1, 0)]:
+                if i + di < size and j + dj < size:
+                    u, v = i * size + j, (i + di) * size + j + dj
+                    graph.add_edge(u, v, length=float(rng.uniform(50, 500)))
+                    graph.add_edge(v, u, length=float(rng.uniform(50, 500)))
+    return graph
+
+
+def make_congestions(way_id, actual, date=20210101000000):
+    return igo.Congestions(
+        np.array(way_id, dtype=np.int64),
+        np.full(len(way_id), date, dtype=np.int64),
+        np.array(actual, dtype=np.int8), np.zeros(len(way_id), dtype=np.int8))
+
+
+def make_highways_edges(graph, highways_nodes):
+    '''
+    Maps highways given as {way_id: [node, ...]} to the edges they cover.
+    '''
+    way_id = sorted(highways_nodes.keys())
+    edges = igo._map_highways_chunk(
+        graph, [np.array(highways_nodes[key]) for key in way_id])
+    return igo.iGraph.__new__(igo.iGraph)._get_highways_edges(
+        np.array(way_id, dtype=np.int64), edges)
+
+
+def make_igraph(graph, highways_edges, congestions):
+    '''
+    Builds an unpartitioned iGraph without downloading anything.
+    '''
+    igraph = igo.iGraph.__new__(igo.iGraph)
+    igraph._overlay = None
+    igraph._highways_edges = highways_edges
+    igraph._congestions = congestions
+    igraph._igraph = igraph._get_igraph(igraph._propagate_congestions(
+        graph, highways_edges, congestions))
+    igraph._index_nodes()
+    return igraph
+
+
+def location(graph, node):
+    return igo.Location(graph.nodes[node]['x'], graph.nodes[node]['y'])
+
+
+def test_lone_request_is_not_delayed():
+    batcher = _Batcher(lambda items: [item * 2 for item in items], 10)
+    start = time.monotonic()
+    assert batcher.submit('a', 1) == 2
+    assert time.monotonic() - start < 1
+
+
+def test_identical_requests_share_a_computation():
+    calls = []
+    release = threading.Event()
+
+    def function(items):
+        calls.append(items)
+        release.wait()
+        return items
+
+    batcher = _Batcher(function, 0)
+    results = []
+    threads = [threading.Thread(
+        target=lambda: results.append(batcher.submit('a', 1)))
+        for i in range(3)]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.1)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert calls == [[1]]
+    assert results == [1, 1, 1]
+
+
+def test_submit_many_shares_a_batch():
+    calls = []
+
+    def function(items):
+        calls.append(items)
+        return items
+
+    batcher = _Batcher(function, 10)
+    assert batcher.submit_many([('a', 1), ('b', 2), ('a', 1)]) == [1, 2, 1]
+    assert calls == [[1, 2]]
+
+
+def test_requests_arriving_within_the_window_are_batched():
+    calls = []
+    release = threading.Event()
+
+    def function(items):
+        calls.append(items)
+        if items == ['slow']:
+            release.wait()
+        return items
+
+    batcher = _Batcher(function, 0.5)
+    results = {}
+
+    def submit(key):
+        results[key] = batcher.submit(key, key)
+
+    # The slow request keeps the batcher busy, so the next ones wait
+    threads = [threading.Thread(target=submit, args=(key,))
+               for key in ['slow', 'b', 'c']]
+    for thread in threads:
+        thread.start()
+        time.sleep(0.05)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert calls[0] == ['slow']
+    assert sorted(calls[1]) == ['b', 'c']
+    assert results == {'slow': 'slow', 'b': 'b', 'c': 'c'}
+
+
+def test_exception_of_an_item_only_fails_its_request():
+    batcher = _Batcher(
+        lambda items: [ValueError(item) if item == 'bad' else item
+                       for item in items], 0)
+    with pytest.raises(ValueError):
+        batcher.submit_many([('good', 'good'), ('bad', 'bad')])
+    assert batcher.submit('good', 'good') == 'good'
+
+
+def test_exception_of_the_function_fails_every_request():
+    def function(items):
+        raise RuntimeError()
+
+    batcher = _Batcher(function, 0)
+    with pytest.raises(RuntimeError):
+        batcher.submit_many([('a', 1), ('b', 2)])
+    # Failed requests are not left in flight
+    with pytest.raises(RuntimeError):
+        batcher.submit('a', 1)
+
+
+def test_replay_loads_the_latest_snapshot_at_or_before_timestamp(
+        tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    igraph = igo.iGraph.__new__(igo.iGraph)
+    first = make_congestions([5, 1, 3], [2, 3, 4], 20210101000000)
+    second = make_congestions([1, 3], [1, 6], 20210102000000)
+    igraph._save_congestions(first)
+    igraph._save_congestions(second)
+    # Files that are not days are ignored
+    (tmp_path / igo.HISTORY_DIRNAME / 'notes.txt').write_text('')
+
+    assert igo.get_history_timestamps() == [20210101000000, 20210102000000]
+    replayed = igraph._load_congestions(20210101235959)
+    assert replayed.way_id.tolist() == [1, 3, 5]
+    assert replayed.actual.tolist() == [3, 4, 2]
+    replayed = igraph._load_congestions(20210102000000)
+    assert replayed.way_id.tolist() == [1, 3]
+    assert replayed.actual.tolist() == [1, 6]
+    with pytest.raises(ValueError):
+        igraph._load_congestions(20201231000000)
+
+
+def test_travel_times_are_none_without_path():
+    graph = make_graph(size=2)
+    graph.remove_edges_from([(2, 0), (0, 2), (1, 3), (3, 1)])
+    # 0 -> 1 is blocked and 2, 3 are disconnected from 0, 1
+    highways_edges = make_highways_edges(graph, {7: [0, 1]})
+    igraph = make_igraph(graph, highways_edges, make_congestions([7], [6]))
+    pairs = [(location(graph, 0), location(graph, 1)),
+             (location(graph, 0), location(graph, 2)),
+             (location(graph, 1), location(graph, 0))]
+    times = igraph.get_travel_times(pairs)
+    assert times[0] is None
+    assert times[1] is None
+    assert times[2] == igraph._igraph[1][0]['itime']
+
+
+def test_batched_routes_are_shortest_paths():
+    graph = make_graph()
+    graph.remove_edges_from(list(graph.in_edges(99)))
+    # 99 cannot be reached, the search stops after settling the sources
+    highways_edges = make_highways_edges(graph, {7: [0, 1, 2, 12]})
+    igraph = make_igraph(graph, highways_edges, make_congestions([7], [6]))
+    pairs = [(source, 55) for source in [0, 9, 90, 55, 54]]
+    pairs += [(0, 99), (9, 99), (90, 99), (3, 4)]
+    paths = igraph._route_pairs(pairs)
+    for (source, target), path in zip(pairs, paths):
+        if target == 99:
+            assert path is None
+            continue
+        assert path[0] == source and path[-1] == target
+        assert nx.path_weight(igraph._igraph, path, 'itime') == \
+            pytest.approx(nx.shortest_path_length(
+                igraph._igraph, source, target, weight='itime'))
+
+
+def test_parsed_congestions_keep_the_latest_row_of_each_highway():
+    igraph = igo.iGraph.__new__(igo.iGraph)
+    congestions = igraph._parse_congestions([
+        '7#20210101001000#3#4\n', '2#20210101000500#1#1\n',
+        '7#20210101000000#5#5\n', '2#20210101001500#6#2\n',
+        '7#20210101000500#2#2\n', '4#20210101000000#0#0\n'])
+    assert congestions.way_id.tolist() == [2, 4, 7]
+    assert congestions.date.tolist() == [
+        20210101001500, 20210101000000, 20210101001000]
+    assert congestions.actual.tolist() == [6, 0, 3]
+    assert congestions.predicted.tolist() == [2, 0, 4]
+
+    empty = igraph._parse_congestions([])
+    assert len(empty.way_id) == 0 and empty.actual.dtype == np.int8
+
+
+def test_actual_congestion_of_highways_missing_on_either_side():
+    igraph = igo.iGraph.__new__(igo.iGraph)
+    congestions = make_congestions([2, 5, 9], [1, 4, 6])
+    actual = igraph._get_actual(np.array([1, 2, 3, 5, 9, 12]), congestions)
+    assert actual.tolist() == [0, 1, 0, 4, 6, 0]
+    assert igraph._get_actual(np.array([2, 5]), make_congestions(
+        [], [])).tolist() == [0, 0]
+    assert igraph._get_actual(np.array([], dtype=np.int64),
+                              congestions).tolist() == []
+
+
+class DummyTimer:
+    def __init__(self, interval, function):
+        pass
+
+    def start(self):
+        pass
+
+
+def test_refresh_matches_a_fresh_build(monkeypatch):
+    graph = make_graph(size=12)
+    highways_edges = make_highways_edges(graph, PARTITION_HIGHWAYS)
+    igraph = make_igraph(graph.copy(), highways_edges,
+                         make_congestions([1, 2, 3, 9], [3, 5, 2, 4]))
+
+    new_congestions = make_congestions([1, 2, 4, 9], [3, 1, 5, 6])
+    monkeypatch.setattr(igo.threading, 'Timer', DummyTimer)
+    monkeypatch.setattr(igraph, '_download_congestions',
+                        lambda url: new_congestions)
+    monkeypatch.setattr(igraph, '_save_congestions', lambda congestions: None)
+    igraph._update_igraph()
+    assert igraph._congestions is new_congestions
+
+    fresh = make_igraph(graph.copy(), highways_edges, new_congestions)
+    for u, v, data in fresh._igraph.edges(data=True):
+        assert igraph._igraph[u][v]['congestion'] == data['congestion']
+        assert igraph._igraph[u][v]['congestionInfo'] == \
+            data['congestionInfo']
+        assert igraph._igraph[u][v]['itime'] == data['itime']
+
+
+def make_partition(graph, highways_edges, congestions):
+    '''
+    Builds a partitioned iGraph without downloading anything.
+    '''
+    partition = igo.iGraph.__new__(igo.iGraph)
+    partition._cells = igo.collections.OrderedDict()
+    partition._cells_lock = threading.Lock()
+    partition._cells_generations = igo.collections.defaultdict(int)
+    partition._igraph = None
+    partition._highways_edges = None
+    partition._split_graph(graph, highways_edges)
+    partition._overlay, cells = partition._customize_partition(congestions)
+    return partition
+
+
+PARTITION_HIGHWAYS = {1: [0, 60, 143], 2: [11, 70], 3: [132, 5], 4: [40, 47]}
+
+
+def assert_same_itimes(partition, igraph, graph, seed=0):
+    # Every edge has the same congestion and itime in its cell
+    known = 0
+    for filename in igo.os.listdir(igo.CELLS_DIRNAME):
+        if filename.endswith('.cell'):
+            cell_graph = partition._load_dict(
+                igo.os.path.join(igo.CELLS_DIRNAME, filename))['graph']
+            for u, v, data in cell_graph.edges(data=True):
+                assert data['congestion'] == \
+                    igraph._igraph[u][v]['congestion']
+                assert data['itime'] == igraph._igraph[u][v]['itime']
+                known += data['congestionInfo']
+    assert known == sum(data['congestionInfo'] for u, v, data in
+                        igraph._igraph.edges(data=True))
+    assert known > 0
+
+    rng = np.random.default_rng(seed)
+    nodes = list(graph.nodes)
+    pairs = [(location(graph, nodes[i]), location(graph, nodes[j]))
+             for i, j in rng.integers(len(nodes), size=(50, 2))]
+    assert partition.get_travel_times(pairs) == \
+        pytest.approx(igraph.get_travel_times(pairs))
+
+
+def test_partition_has_the_itimes_of_the_unpartitioned_graph(
+        tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    graph = make_graph(size=12)
+    highways_edges = make_highways_edges(graph, PARTITION_HIGHWAYS)
+    congestions = make_congestions([1, 2, 3, 9], [3, 5, 2, 4])
+    partition = make_partition(graph.copy(), highways_edges, congestions)
+    assert len(partition._overlay.graph['congestion']) == \
+        graph.number_of_edges()
+    igraph = make_igraph(graph.copy(), highways_edges, congestions)
+    assert_same_itimes(partition, igraph, graph)
+
+    # Only the cells whose congestions change are customized again
+    new_congestions = make_congestions([1, 2, 3, 4], [3, 1, 2, 5])
+    overlay, cells = partition._customize_partition(
+        new_congestions, partition._overlay)
+    assert 0 < len(cells) < 9
+    partition._overlay = overlay
+    partition._cells.clear()
+    igraph = make_igraph(graph.copy(), highways_edges, new_congestions)
+    assert_same_itimes(partition, igraph, graph)
+
+    # Nothing changes, nothing is customized
+    assert partition._customize_partition(
+        new_congestions, partition._overlay) == (partition._overlay, [])
+
+
+def test_cell_customized_while_loading_is_not_cached(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    graph = make_graph(size=12)
+    highways_edges = make_highways_edges(graph, PARTITION_HIGHWAYS)
+    partition = make_partition(graph, highways_edges,
+                               make_congestions([1], [3]))
+    cell = partition._get_cell(location(graph, 0))
+    load_dict = partition._load_dict
+
+    def load_dict_during_update(filename):
+        data = load_dict(filename)
+        partition._cells_generations[cell] += 1
+        return data
+
+    partition._load_dict = load_dict_during_update
+    assert partition._get_cell_data(cell) is not None
+    assert cell not in partition._cells
+    partition._load_dict = load_dict
+    partition._get_cell_data(cell)
+    assert cell in partition._cells
+
+
+def test_partitioned_graph_cannot_be_plotted(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    graph = make_graph(size=4)
+    partition = make_partition(graph, make_highways_edges(graph, {}),
+                               make_congestions([], []))
+    with pytest.raises(ValueError):
+        partition.plot_graph()
+
+
+def test_stage_is_loaded_from_cache_and_recomputed_on_new_inputs(
+        tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    igraph = igo.iGraph.__new__(igo.iGraph)
+    calls = []
+
+    def square(value):
+        calls.append(value)
+        return value * value
+
+    first = igraph._run_stage('square', square, ('hash-3', 3))
+    assert first == (igraph._get_hash(9), 9)
+    assert igraph._run_stage('square', square, ('hash-3', 3)) == first
+    assert calls == [3]
+    stale = igo.os.listdir(igo.CACHE_DIRNAME)
+    assert len(stale) == 1
+
+    # A changed input recomputes the stage and removes the stale artifact
+    assert igraph._run_stage('square', square, ('hash-4', 4))[1] == 16
+    assert calls == [3, 4]
+    files = igo.os.listdir(igo.CACHE_DIRNAME)
+    assert len(files) == 1 and files != stale
+
+    # Other stages are kept
+    igraph._run_stage('other', square, ('hash-3', 3))
+    assert len(igo.os.listdir(igo.CACHE_DIRNAME)) == 2
+
+
+def test_stage_key_depends_on_the_cache_version(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    igraph = igo.iGraph.__new__(igo.iGraph)
+    igraph._run_stage('stage', lambda value: 'old', ('hash', None))
+    monkeypatch.setattr(igo, 'CACHE_VERSION', igo.CACHE_VERSION + 1)
+    assert igraph._run_stage('stage', lambda value: 'new',
+                             ('hash', None))[1] == 'new'